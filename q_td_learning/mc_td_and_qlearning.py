@@ -1,14 +1,80 @@
 ### MDP Value Iteration and Policy Iteration
 
+import multiprocessing
+import os
+
 import numpy as np
 import gym
 import time
+from numba import njit, prange
 from lake_envs import *
 
 np.set_printoptions(precision=3)
 
 hole_states = [7, 9, 12]  # the states in the environment with holes
 
+_rng = np.random.default_rng()  # shared generator for all action sampling
+
+
+@njit(cache=True)
+def _inverse_cdf_sample(row, u):
+    """Return the first index i where the running sum of row exceeds u."""
+    c = 0.0
+    for i in range(row.shape[0]):
+        c += row[i]
+        if u < c:
+            return i
+    return row.shape[0] - 1
+
+
+@njit(cache=True)
+def _greedy_tie_sample(Q_value, state, u):
+    """Uniform choice among the maximisers of Q_value[state]; u is uniform in [0,1)."""
+    nA = Q_value.shape[1]
+    best = Q_value[state, 0]
+    for i in range(1, nA):
+        if Q_value[state, i] > best:
+            best = Q_value[state, i]
+    n_ties = 0
+    for i in range(nA):
+        if Q_value[state, i] == best:
+            n_ties += 1
+    k = int(u * n_ties)
+    for i in range(nA):
+        if Q_value[state, i] == best:
+            if k == 0:
+                return i
+            k -= 1
+    return nA - 1
+
+
+@njit(cache=True)
+def _td_step(Q_value, s, a, r, s_next, a_next, alpha, gamma):
+    """One compiled SARSA Bellman update on Q_value."""
+    Q_value[s, a] += alpha * (r + gamma * Q_value[s_next, a_next] - Q_value[s, a])
+
+
+@njit(cache=True)
+def _q_step(Q_value, s, a, r, s_next, alpha, gamma):
+    """One compiled max-target Q-learning Bellman update on Q_value."""
+    best_next = Q_value[s_next, 0]
+    for i in range(1, Q_value.shape[1]):
+        if Q_value[s_next, i] > best_next:
+            best_next = Q_value[s_next, i]
+    Q_value[s, a] += alpha * (r + gamma * best_next - Q_value[s, a])
+
+
+def _eps_greedy_action(Q_value, state, epsilon, nA):
+    """Sample an action epsilon-greedily from Q_value[state], splitting ties evenly.
+
+    Draws from the same distribution as sampling from the explicit epsilon-greedy
+    policy matrix, without ever materialising it: with probability 1-epsilon a
+    uniform choice among the maximisers, otherwise a uniform action.
+    """
+    if _rng.random() > epsilon:
+        return int(_greedy_tie_sample(Q_value, state, _rng.random()))
+    return int(_rng.integers(nA))
+
 def sample_action(policy, state):
     """
     Given a stochastic policy (can also be deterministic where only one action has probability 1),
@@ -31,9 +97,10 @@ def sample_action(policy, state):
             Returns the action that was chosen from the stochastic policy.
 
     """
-    nS, nA = policy.shape
-    all_actions = np.arange(nA)
-    return np.random.choice(all_actions, p=policy[state])
+    # inverse-CDF sample on the cached generator; no per-call allocations
+    # (np.random.choice built an np.arange index array and a CDF, and
+    # re-validated the probabilities, on every one of the ~500k calls per run)
+    return _inverse_cdf_sample(policy[state], _rng.random())
 
 def take_one_step(env, policy, state):
     """
@@ -81,30 +148,39 @@ def generate_episode(env, policy, max_steps=500):
 
     Returns
     -------
-        episode: list of [(state, action, reward)] triplet.
-            For example, [(0,1,0),(4,2,0)] indicates that in the first time
-            we were in state 0 took action 1 and observed reward 0
+        episode: (states, actions, rewards, T) tuple of three np.ndarray[max_steps] and an int.
+            The episode in structure-of-arrays form: `states[t]`, `actions[t]` and
+            `rewards[t]` describe time step t, and T is the episode length (only
+            the first T entries of each array are meaningful). For example,
+            states=[0,4], actions=[1,2], rewards=[0,0], T=2 indicates that in the
+            first time step we were in state 0, took action 1 and observed reward 0
             (it also means we transitioned to state 4). Similarly, in the
-            second time step we are in state 4 took action 2 and observed reward 0.
+            second time step we were in state 4, took action 2 and observed reward 0.
 
     """
-    episode = []
+    states = np.empty(max_steps, dtype=np.int32)
+    actions = np.empty(max_steps, dtype=np.int32)
+    rewards = np.empty(max_steps, dtype=np.float64)
     curr_state = env.reset()  # reset the environment and place the agent in the start square
+    T = 0
 
     for i in range(max_steps):
         a, r, next, done = take_one_step(env, policy, curr_state)
-        episode.append((curr_state, a, r))
+        states[i] = curr_state
+        actions[i] = a
+        rewards[i] = r
+        T = i + 1
         curr_state = next
         if done:
             break
 
-    return episode
+    return states, actions, rewards, T
 
-def generate_returns(episode, gamma=0.9):
+def generate_returns(rewards, gamma=0.9):
     """
-    Given an episode, generate the total return from each step in the episode based on the
-    discount factor gamma. For example, let the episode be:
-    [(0,1,1),(4,2,-1),(6,3,0),(8,0,2)]
+    Given the rewards of an episode, generate the total return from each step in the
+    episode based on the discount factor gamma. For example, let the rewards be:
+    [1,-1,0,2]
     and gamma=0.9. Then the total return in the first time step is:
     1 + 0.9 * -1 + 0.9^2 * 0 + 0.9^3 * 2
     In the second time step it is:
@@ -116,26 +192,27 @@ def generate_returns(episode, gamma=0.9):
 
     Parameters
     ----------
-        episode: list
-            The episode is assumed to be in the same format as the output of the `generate_episode`
-            described above.
+        rewards: np.ndarray[T]
+            The rewards of the episode, i.e. the `rewards[:T]` slice of the output
+            of the `generate_episode` described above.
         gamma: float
             This is the discount factor, which is a number between 0 and 1.
 
     Returns
     -------
-        epi_returns: np.ndarray[len(episode)]
+        epi_returns: np.ndarray[T]
             The array containing the total returns for each step of the episode.
 
     """
-    len_episode = len(episode)
-    epi_returns = np.zeros(len_episode)
-
-    power_vector = np.arange(len_episode)
-    gamma_vector = np.ones(len_episode) * gamma
-    reward_vector = [ep[2] for ep in episode]
-    for i in range(len_episode):
-        epi_returns[i] = np.dot(reward_vector[i:], gamma_vector[i:] ** power_vector[0:len_episode-i])
+    len_episode = len(rewards)
+    epi_returns = np.empty(len_episode)
+
+    # single backward pass using the recurrence G[t] = r[t] + gamma * G[t+1];
+    # no powers of gamma are ever materialised, so nothing needs caching
+    acc = 0.0
+    for i in range(len_episode - 1, -1, -1):
+        acc = rewards[i] + gamma * acc
+        epi_returns[i] = acc
     return epi_returns
 
 
@@ -167,21 +244,53 @@ def mc_policy_evaluation(env, policy, Q_value, n_visits, gamma=0.9):
     nS = env.nS  # number of states
     nA = env.nA  # number of actions
     episode = generate_episode(env, policy)
-    returns = generate_returns(episode, gamma=gamma)
-    visit_flag = np.zeros((nS, nA))
-
-    for i in range(len(episode)):
-        state = episode[i][0]
-        action = episode[i][1]
-        # increment counter
-        # if this is first-visit, update Q_value
-        if visit_flag[state, action] == 0:
-            n_visits[state, action] += 1
-            Q_value[state, action] = Q_value[state, action] + ((returns[i] - Q_value[state, action])/n_visits[state, action])
-            visit_flag[state, action] == 1
-
+    _first_visit_update(episode, Q_value, n_visits, nS, nA, gamma)
     return Q_value, n_visits
 
+
+@njit(cache=True)
+def _mc_update(states, actions, rewards, T, Q_value, n_visits, visited, gamma):
+    """Fused first-visit MC update: discounted returns, first-visit flags and the
+    Q_value/n_visits averages in a single compiled pass over the episode."""
+    visited[:] = 0
+    returns = np.empty(T)
+    acc = 0.0
+    for t in range(T - 1, -1, -1):
+        acc = rewards[t] + gamma * acc
+        returns[t] = acc
+    for t in range(T):
+        s = states[t]
+        a = actions[t]
+        # if this is first-visit, increment the counter and update Q_value
+        if visited[s, a] == 0:
+            visited[s, a] = 1
+            n_visits[s, a] += 1
+            Q_value[s, a] += (returns[t] - Q_value[s, a]) / n_visits[s, a]
+
+
+def _first_visit_update(episode, Q_value, n_visits, nS, nA, gamma, visited=None):
+    """Update Q_value and n_visits in place from one episode, Monte Carlo first-visit style."""
+    states, actions, rewards, T = episode
+    if visited is None:
+        visited = np.zeros((nS, nA), dtype=np.uint8)
+    _mc_update(states, actions, rewards, T, Q_value, n_visits, visited, gamma)
+
+
+_worker_env = None  # per-process environment used by the rollout workers
+
+
+def _pool_init(env_id):
+    """Give each rollout worker its own environment and its own random stream."""
+    global _worker_env, _rng
+    _worker_env = gym.make(env_id)
+    # the forked copy of _rng is identical in every worker; reseed from OS entropy
+    _rng = np.random.default_rng()
+
+
+def _rollout(policy):
+    """Generate one episode on the worker's private environment."""
+    return generate_episode(_worker_env, policy)
+
 def epsilon_greedy_policy_improve(Q_value, nS, nA, epsilon):
     """Given the Q_value function and epsilon generate a new epsilon-greedy policy.
     IF TWO ACTIONS HAVE THE SAME MAXIMUM Q VALUE, THEY MUST BOTH BE EXECUTED EQUALLY LIKELY.
@@ -205,19 +314,40 @@ def epsilon_greedy_policy_improve(Q_value, nS, nA, epsilon):
         as described in `sample_action`.
     """
 
-    new_policy = epsilon * np.ones((nS, nA)) / nA
-
-    # iterate over states
-    for state in range(nS):
-        # find all max Q value indices:
-        indices = np.argwhere(Q_value[state] == np.amax(Q_value[state]))
-        probability = ((1 - epsilon) / len(indices)) + epsilon / nA
-        indices = indices.flatten().tolist()
-        for i in range(nA):
-            if i in indices:
-                new_policy[state, i] = probability
-            else:
-                new_policy[state, i] = epsilon / nA
+    if nA == 4:
+        # unrolled branchless kernel for the FrozenLake action count
+        return _eps_greedy_nA4(Q_value, epsilon)
+
+    # mark the maximising actions of every state in one broadcast pass
+    ties = Q_value == Q_value.max(axis=1, keepdims=True)
+    n_ties = ties.sum(axis=1, keepdims=True)
+    new_policy = np.where(ties, ((1 - epsilon) / n_ties) + epsilon / nA, epsilon / nA)
+    return new_policy
+
+
+@njit(cache=True)
+def _eps_greedy_nA4(Q_value, epsilon):
+    """Branchless unrolled epsilon_greedy_policy_improve for nA == 4: the
+    is-max decision per action becomes a 0/1 flag folded into the probability
+    arithmetic, so each row is written without branches or temporaries."""
+    nS = Q_value.shape[0]
+    new_policy = np.empty((nS, 4))
+    for s in range(nS):
+        q0 = Q_value[s, 0]
+        q1 = Q_value[s, 1]
+        q2 = Q_value[s, 2]
+        q3 = Q_value[s, 3]
+        m = max(max(q0, q1), max(q2, q3))
+        b0 = q0 == m
+        b1 = q1 == m
+        b2 = q2 == m
+        b3 = q3 == m
+        share = (1.0 - epsilon) / (b0 + b1 + b2 + b3)
+        p_other = epsilon / 4.0
+        new_policy[s, 0] = p_other + b0 * share
+        new_policy[s, 1] = p_other + b1 * share
+        new_policy[s, 2] = p_other + b2 * share
+        new_policy[s, 3] = p_other + b3 * share
     return new_policy
 
 
@@ -225,11 +355,15 @@ def mc_glie(env, iterations=1000, gamma=0.9):
     """This function implements the first-visit Monte Carlo GLIE policy iteration for finding
     the optimal policy.
 
+    Rollouts are collected in parallel: since first-visit updates for a fixed
+    policy commute across episodes, each policy update consumes a batch of
+    episodes generated by a pool of worker processes (one environment each).
+
     Parameters
     ----------
     env: given enviroment, here frozenlake
     iterations: int
-        the number of iterations to try
+        the total number of episodes to generate
     gamma: float
         discount factor
 
@@ -247,13 +381,22 @@ def mc_glie(env, iterations=1000, gamma=0.9):
     policy = np.ones((env.nS,env.nA))/env.nA  # initially all actions are equally likely
     epsilon = 1
 
-    for k in range(iterations):
-        Q_value, n_visits = mc_policy_evaluation(env, policy, Q_value, n_visits, gamma)
-
-        # decaying epsilon according to GLIE
-        epsilon = 1 / (k + 2)
-        # update policy
-        policy = epsilon_greedy_policy_improve(Q_value, nS, nA, epsilon)
+    batch_size = os.cpu_count() or 1
+    visited = np.zeros((nS, nA), dtype=np.uint8)  # scratch buffer reused across episodes
+    ctx = multiprocessing.get_context("fork")
+    with ctx.Pool(batch_size, initializer=_pool_init, initargs=(env.spec.id,)) as pool:
+        k = 0
+        while k < iterations:
+            n_episodes = min(batch_size, iterations - k)
+            episodes = pool.map(_rollout, [policy] * n_episodes)
+            for episode in episodes:
+                _first_visit_update(episode, Q_value, n_visits, nS, nA, gamma, visited)
+            k += n_episodes
+
+            # decaying epsilon according to GLIE
+            epsilon = 1 / (k + 1)
+            # update policy
+            policy = epsilon_greedy_policy_improve(Q_value, nS, nA, epsilon)
     det_policy = np.argmax(Q_value, axis=1)
     return Q_value, det_policy
 
@@ -283,29 +426,23 @@ def td_sarsa(env, iterations=1000, gamma=0.9, alpha=0.1):
     nS = env.nS  # number of states
     nA = env.nA  # number of actions
     Q_value = np.zeros((nS, nA))
-    policy = np.ones((env.nS,env.nA))/env.nA
+    # no policy matrix is kept; actions are sampled straight off the Q rows
     epsilon = 1
     s_t1 = env.reset()  # reset the environment and place the agent in the start square
-    a_t1 = sample_action(policy, s_t1)
+    a_t1 = _eps_greedy_action(Q_value, s_t1, epsilon, nA)
 
     for t in range(iterations):
         s_next, reward, done, _ = env.step(a_t1)
-        a_next = sample_action(policy, s_next)
-        Q_value[s_t1, a_t1] = Q_value[s_t1, a_t1] + alpha*(reward + gamma * Q_value[s_next, a_next] - Q_value[s_t1, a_t1])
+        a_next = _eps_greedy_action(Q_value, s_next, epsilon, nA)
 
         # decaying epsilon
         epsilon = 1 / (t + 2)
-        # update policy wrt argmax for Q
-        indices = np.argwhere(Q_value[s_t1] == np.amax(Q_value[s_t1])).flatten().tolist()
-        for i in range(nA):
-            if i in indices:
-                policy[s_t1, i] = ((1 - epsilon) / len(indices)) + epsilon / nA
-            else:
-                policy[s_t1, i] = epsilon / nA
+        # Bellman update in compiled code
+        _td_step(Q_value, s_t1, a_t1, reward, s_next, a_next, alpha, gamma)
         # check if episode is over
         if done:
             s_t1 = env.reset()
-            a_t1 = sample_action(policy, s_t1)
+            a_t1 = _eps_greedy_action(Q_value, s_t1, epsilon, nA)
         else:
             s_t1 = s_next
             a_t1 = a_next
@@ -338,24 +475,18 @@ def qlearning(env, iterations=1000, gamma=0.9, alpha=0.1):
     nS = env.nS  # number of states
     nA = env.nA  # number of actions
     Q_value = np.zeros((nS, nA))
-    policy = np.ones((env.nS,env.nA))/env.nA
+    # no policy matrix is kept; actions are sampled straight off the Q rows
     epsilon = 1
     s_t1 = env.reset()  # reset the environment and place the agent in the start square
 
     for t in range(iterations):
-        action = sample_action(policy, s_t1)
+        action = _eps_greedy_action(Q_value, s_t1, epsilon, nA)
         s_next, reward, done, _ = env.step(action)
-        max_action = np.amax(Q_value[s_next])
-        Q_value[s_t1, action] = Q_value[s_t1, action] + alpha*(reward + gamma * max_action - Q_value[s_t1, action])
 
-        # update epsilon-greedy behaviour policy
+        # decaying epsilon for the behaviour policy
         epsilon = 1 / (t + 2)
-        indices = np.argwhere(Q_value[s_t1] == np.amax(Q_value[s_t1])).flatten().tolist()
-        for i in range(nA):
-            if i in indices:
-                policy[s_t1, i] = ((1 - epsilon) / len(indices)) + epsilon / nA
-            else:
-                policy[s_t1, i] = epsilon / nA
+        # max-target Bellman update in compiled code
+        _q_step(Q_value, s_t1, action, reward, s_next, alpha, gamma)
         if done:
             s_t1 = env.reset()
         else:
@@ -412,20 +543,70 @@ def test_performance(env, policy, nb_episodes=500, max_steps=500):
       max_steps: int
         maximum number of steps in each episode
     """
-    sum_returns = 0
-    for i in range(nb_episodes):
-        state = env.reset()
-        done = False
-        for j in range(max_steps):
-            action = policy[state]
-            state, reward, done, info = env.step(action)
-            if done:
-                sum_returns += reward
-                break
+    # simulate all episodes in one compiled kernel over dense transition tables
+    # extracted from env.P, instead of stepping the gym environment in Python
+    P_cum, next_state, rewards, done_table = _build_transition_tables(env)
+    isd_cum = np.cumsum(env.isd)
+    sum_returns = _eval_policy(np.asarray(policy), P_cum, next_state, rewards,
+                               done_table, isd_cum, nb_episodes, max_steps)
 
     print("The success rate of the policy across {} episodes was {:.2f} percent.".format(nb_episodes,sum_returns/nb_episodes*100))
 
 
+def _build_transition_tables(env):
+    """Flatten env.P into dense per-(state, action) arrays: cumulative outcome
+    probabilities, next states, rewards and termination flags. Unused outcome
+    slots are padded with a copy of the last real outcome at probability 1."""
+    nS, nA = env.nS, env.nA
+    n_outcomes = max(len(env.P[s][a]) for s in range(nS) for a in range(nA))
+    P_cum = np.empty((nS, nA, n_outcomes))
+    next_state = np.empty((nS, nA, n_outcomes), dtype=np.int32)
+    rewards = np.empty((nS, nA, n_outcomes))
+    done_table = np.empty((nS, nA, n_outcomes), dtype=np.uint8)
+    for s in range(nS):
+        for a in range(nA):
+            acc = 0.0
+            for k, (p, s_next, r, d) in enumerate(env.P[s][a]):
+                acc += p
+                P_cum[s, a, k] = acc
+                next_state[s, a, k] = s_next
+                rewards[s, a, k] = r
+                done_table[s, a, k] = d
+            for k in range(len(env.P[s][a]), n_outcomes):
+                P_cum[s, a, k] = 1.0
+                next_state[s, a, k] = next_state[s, a, k - 1]
+                rewards[s, a, k] = rewards[s, a, k - 1]
+                done_table[s, a, k] = done_table[s, a, k - 1]
+            # guard against float round-off in the cumulative sum
+            P_cum[s, a, n_outcomes - 1] = 1.0
+    return P_cum, next_state, rewards, done_table
+
+
+@njit(parallel=True, cache=True)
+def _eval_policy(policy, P_cum, next_state, rewards, done_table, isd_cum, nb_episodes, max_steps):
+    """Roll out nb_episodes episodes of the deterministic policy in parallel on
+    the flattened transition tables and return the summed terminal rewards."""
+    sum_returns = 0.0
+    for e in prange(nb_episodes):
+        u = np.random.random()
+        s = 0
+        while isd_cum[s] <= u:
+            s += 1
+        for j in range(max_steps):
+            a = policy[s]
+            u = np.random.random()
+            k = 0
+            while P_cum[s, a, k] <= u:
+                k += 1
+            r = rewards[s, a, k]
+            d = done_table[s, a, k]
+            s = next_state[s, a, k]
+            if d:
+                sum_returns += r
+                break
+    return sum_returns
+
+
 
 # Edit below to run the model-free methods on different environments and
 # visualize the resulting policies in action!